@@ -19,6 +19,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import tifffile
 import pickle
 import json
+import os
+import collections
+import concurrent.futures
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -486,3 +489,242 @@ def quicklevel(array,cursor1,cursor2):
     leveleddata = array - genvals
     return [leveleddata,genvals]
 
+
+
+def grayvalues(imgarray, rgb):
+    """
+    Return the intensities of the grayscale pixels of an image or stack as a flat
+    array. For RGB arrays only pixels with equal channels are kept, which leaves out
+    annotations such as the center of mass marker added by display_cm_overlay.
+
+    Keyword arguments:
+    imgarray -- tiff image or stack as a numpy array
+    rgb -- whether the last axis of imgarray holds the 3 RGB channels
+    """
+
+    if not rgb:
+        return imgarray.ravel()
+    gray = (imgarray[..., 0] == imgarray[..., 1]) & (
+        imgarray[..., 1] == imgarray[..., 2]
+    )
+    return imgarray[..., 0][gray]
+
+
+def streamhistogram(imgstack, bins=4096, histrange=None):
+    """
+    Accumulate the intensity histogram of an image stack in a single pass, one frame
+    at a time, so that large (or memory mapped) stacks are never copied as a whole.
+    8 and 16 bit unsigned integer stacks are binned exactly, one bin per intensity
+    value. Other stacks are binned over the range seen so far, which is doubled
+    (merging pairs of bins) whenever a frame falls outside of it. Non-finite values
+    (NaN, inf) are skipped. For RGB stacks (such as the output of display_cm_overlay)
+    only the grayscale pixels are binned (see grayvalues).
+
+    Keyword arguments:
+    imgstack -- tiff stack as a numpy array (frames, rows, columns[, 3])
+    bins -- number of bins used for inexact binning, rounded up to an even number
+    histrange -- fixed (min, max) range for inexact binning, values outside of it
+    are ignored
+    """
+
+    rgb = imgstack.ndim == 4
+    exact = imgstack.dtype.itemsize <= 2
+    if np.issubdtype(imgstack.dtype, np.unsignedinteger) and exact:
+        # exact histogram, the bin index is the intensity value itself
+        counts = np.zeros(np.iinfo(imgstack.dtype).max + 1, dtype=np.int64)
+        for frame in imgstack:
+            counts += np.bincount(grayvalues(frame, rgb), minlength=counts.size)
+        edges = np.arange(counts.size + 1)
+        return (counts, edges)
+
+    bins += bins % 2
+    counts = np.zeros(bins, dtype=np.int64)
+    lowedge, highedge = (None, None) if histrange is None else histrange
+    for frame in imgstack:
+        values = grayvalues(frame, rgb)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            continue
+        if histrange is None:
+            framemin, framemax = float(values.min()), float(values.max())
+            if lowedge is None:
+                lowedge, highedge = framemin, framemax
+                if highedge == lowedge:
+                    # constant frame, widen relative to its magnitude
+                    highedge += max(abs(lowedge), 1.0) * 1e-6
+            # double the range towards the new values until the frame fits
+            while framemin < lowedge or framemax > highedge:
+                width = highedge - lowedge
+                merged = counts.reshape(-1, 2).sum(axis=1)
+                counts[:] = 0
+                if framemin < lowedge:
+                    counts[bins // 2 :] = merged
+                    lowedge -= width
+                else:
+                    counts[: bins // 2] = merged
+                    highedge += width
+        framecounts, _ = np.histogram(values, bins=bins, range=(lowedge, highedge))
+        counts += framecounts
+
+    if lowedge is None:
+        raise ValueError("The image stack contains no finite pixel values.")
+    edges = np.linspace(lowedge, highedge, bins + 1)
+    return (counts, edges)
+
+
+def autoscalelimits(imgstack, low=0.1, high=99.9, method="histogram"):
+    """
+    Find the intensity limits for displaying an image stack by clipping the lowest
+    and highest percentage of pixel values. Non-finite pixels (NaN, inf) and the
+    coloured pixels of RGB stacks are ignored.
+
+    Keyword arguments:
+    imgstack -- tiff image or stack as a numpy array
+    low -- percentile of pixel intensities mapped to black
+    high -- percentile of pixel intensities mapped to white
+    method [histogram, percentile] -- find the percentiles from a histogram
+    accumulated in one pass over the stack, or exactly with numpy (which copies
+    and sorts the whole stack)
+    """
+
+    if method == "histogram":
+        counts, edges = streamhistogram(imgstack)
+        # integer cumulative counts so that high=100 lands exactly on the last
+        # occupied bin, and side="right" skips empty bins below the data
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        lastbin = counts.size - 1
+        lowbin = np.searchsorted(cumulative, total * low / 100.0, side="right")
+        highbin = np.searchsorted(cumulative, total * high / 100.0, side="left")
+        lowbin, highbin = min(lowbin, lastbin), min(highbin, lastbin)
+        lower = edges[lowbin]
+        exact = imgstack.dtype.itemsize <= 2
+        if np.issubdtype(imgstack.dtype, np.unsignedinteger) and exact:
+            # exact bins hold only the intensity value of their lower edge
+            upper = edges[highbin]
+        else:
+            upper = edges[highbin + 1]
+    elif method == "percentile":
+        values = grayvalues(imgstack, imgstack.ndim == 4)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            raise ValueError("The image stack contains no finite pixel values.")
+        lower, upper = np.percentile(values, [low, high])
+    else:
+        raise ValueError("Invalid autoscale method. Enter histogram or percentile.")
+
+    if upper <= lower:
+        upper = lower + 1
+    return (float(lower), float(upper))
+
+
+def scaleframe(frame, lower, upper):
+    """
+    Linearly rescale a single frame to 8 bits, mapping lower to 0 and upper to 255.
+    NaN pixels are set to 0. For RGB frames, coloured pixels (e.g. the center of
+    mass marker added by display_cm_overlay) are kept unscaled so the overlay stays
+    visible.
+
+    Keyword arguments:
+    frame -- single tiff image as a numpy array (rows, columns[, 3])
+    lower -- intensity mapped to black
+    upper -- intensity mapped to white
+    """
+
+    scale = 255.0 / (upper - lower)
+    scaled = np.clip((frame.astype(np.float32) - lower) * scale, 0, 255)
+    scaled = np.nan_to_num(scaled).astype(np.uint8)
+    if frame.ndim == 3:
+        # grayscale pixels have equal channels, anything else is an annotation
+        coloured = (frame[..., 0] != frame[..., 1]) | (frame[..., 1] != frame[..., 2])
+        scaled[coloured] = np.nan_to_num(np.clip(frame[coloured], 0, 255))
+    return scaled
+
+
+def exportstack(
+    imgstack,
+    name,
+    sequence=False,
+    rgb=False,
+    low=0.1,
+    high=99.9,
+    method="histogram",
+    compress=1,
+    workers=None,
+):
+    """
+    Autoscale an image stack to 8 bits and save it as a compressed multi-page tiff
+    (name.tif) or as a sequence of tiff images (name_00000.tif, name_00001.tif, ...)
+    for presentations. The output of display_cm_overlay can be passed directly and
+    is saved as RGB.
+
+    Frames are scaled in a thread pool. For a sequence, each frame is also
+    compressed and written in the pool, so this is the fast route for long stacks
+    on a multi-core machine. A multi-page tiff is compressed page by page as it is
+    written, which dominates the export time, so the default compression level is
+    low; raise compress for smaller files at the cost of speed.
+
+    Keyword arguments:
+    imgstack -- tiff image or stack as a numpy array (frames, rows, columns) or
+    (frames, rows, columns, 3) for RGB
+    name -- name of the exported file(s) without extension
+    sequence -- write one file per frame instead of a single multi-page tiff
+    rgb -- treat a 3D array as a single RGB image (rows, columns, 3) rather than a
+    grayscale stack
+    low, high -- percentiles used for autoscaling (see autoscalelimits)
+    method [histogram, percentile] -- how the autoscale percentiles are found
+    compress -- zlib compression level from 0 (none) to 9
+    workers -- number of threads, defaults to the number of processors
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if imgstack.ndim == 2 or (imgstack.ndim == 3 and rgb):
+        # promote single images to a stack of one frame
+        imgstack = imgstack[np.newaxis]
+    if imgstack.ndim == 4 and imgstack.shape[-1] != 3:
+        raise ValueError("RGB images must have 3 channels in the last axis.")
+    photometric = "rgb" if imgstack.ndim == 4 else "minisblack"
+    lower, upper = autoscalelimits(imgstack, low, high, method)
+
+    def writeframe(index):
+        frame = scaleframe(imgstack[index], lower, upper)
+        tifffile.imsave(
+            "{}_{:05d}.tif".format(name, index),
+            frame,
+            compress=compress,
+            photometric=photometric,
+        )
+
+    def encodeframe(index):
+        return scaleframe(imgstack[index], lower, upper)
+
+    def writepage(tif, frame):
+        # without a shape description per page, the pages are read back as one
+        # series (compressed pages are never written as one contiguous series)
+        tif.save(frame, compress=compress, photometric=photometric, metadata=None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        if sequence:
+            # each frame is an independent file, so scaling, compression and
+            # writing all happen in the pool
+            futures = [executor.submit(writeframe, i) for i in range(len(imgstack))]
+            for future in futures:
+                future.result()
+        else:
+            # pages of a single tiff must be written in order, so scale frames
+            # ahead in the pool while keeping only a bounded queue in memory
+            ahead = 4 * workers
+            # 8 bit output, so the number of elements is the size in bytes
+            bigtiff = imgstack.size > 2 ** 32 - 2 ** 25
+            pending = collections.deque()
+            with tifffile.TiffWriter(name + ".tif", bigtiff=bigtiff) as tif:
+                for index in range(len(imgstack)):
+                    pending.append(executor.submit(encodeframe, index))
+                    if len(pending) >= ahead:
+                        writepage(tif, pending.popleft().result())
+                while pending:
+                    writepage(tif, pending.popleft().result())
+
+    return (lower, upper)